@@ -21,13 +21,152 @@
 The core of autocrc. Performs the CRC-checks independent of what kind
 of interface is used
 """
+import collections
+import errno
+import functools
+import itertools
 import mmap
 import os
 import re
+import stat
+import sys
 import zlib
 
+# The pattern used to find CRCs in file names. The groups are numbered in
+# order of precedence
+_CRC_PATTERN = re.compile(
+    r'\[(?P<brackets>[a-fA-F0-9]{8})\]|'
+    r'\((?P<parentheses>[a-fA-F0-9]{8})\)|'
+    r'_(?P<underscores>[a-fA-F0-9]{8})_')
+
+_HEX_DIGITS = b'0123456789abcdefABCDEF'
+
+
+def walk(top, recursive=False, follow_links=False):
+    """
+    Generates (dir_name, file_names) pairs for top and, if recursive is true,
+    every directory below it, where file_names are the regular files in
+    dir_name. Works like os.walk but uses the file types cached by os.scandir
+    instead of stat'ing every file. Errors are only raised for top when not
+    recursive, just like os.walk ignores them
+    """
+    file_names = []
+    dir_names = []
+    try:
+        with os.scandir(top) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        file_names.append(entry.name)
+                    elif recursive and entry.is_dir() and \
+                            (follow_links or not entry.is_symlink()):
+                        dir_names.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        if not recursive:
+            raise
+        return
+
+    yield top, file_names
+
+    for dir_name in dir_names:
+        yield from walk(os.path.join(top, dir_name), recursive, follow_links)
+
+
+def map_file(fd):
+    """
+    Returns a read-only mapping of the file descriptor fd. The kernel is told
+    that the file will be read sequentially, which makes it use a larger
+    readahead window
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    map_ = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    # Page faults on the mapping get the same readahead, and the pages are
+    # not kept around as recently used after they have been read
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        map_.madvise(mmap.MADV_SEQUENTIAL)
+    return map_
+
+
+def open_regular_file(file_path):
+    """
+    Opens file_path for reading and returns a (fd, size) tuple. The open
+    doesn't block on named pipes, and anything but a regular file raises an
+    OSError so that it's reported as a read error
+    """
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0) |
+                 getattr(os, 'O_BINARY', 0))
+    try:
+        file_stat = os.fstat(fd)
+        if stat.S_ISDIR(file_stat.st_mode):
+            raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), file_path)
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise OSError(errno.EINVAL, "Not a regular file", file_path)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd, file_stat.st_size
+
+
+def prefetch_file(file_path, length, mmap_threshold=65536):
+    """
+    Opens file_path like open_regular_file and asks the kernel to start
+    reading the first length bytes of it in the background. Returns the
+    (fd, size) tuple, or None if the file couldn't be opened. Errors are
+    reported when the file is CRC-checked
+    """
+    try:
+        fd, size = open_regular_file(file_path)
+    except OSError:
+        return None
+    # Small files are read with a single read() anyway
+    if size >= mmap_threshold and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+    return fd, size
+
+
+def crc32_of_fd(fd, size, mmap_threshold=65536):
+    """
+    Returns the CRC of the size bytes in the open file descriptor fd as an
+    int. The descriptor is left open
+    """
+    # Setting up a mapping costs more than reading small files
+    if size < mmap_threshold:
+        current = zlib.crc32(os.read(fd, size))
+    else:
+        with map_file(fd) as map_:
+            current = zlib.crc32(map_)
+
+    return current & 0xFFFFFFFF
+
+
+def crc32_of_file(file_path, mmap_threshold=65536):
+    """
+    Returns the CRC of the file file_path as an int. No hooks are called, so
+    it can be run by worker threads and processes
+    """
+    # The file is used through its descriptor, a file object would stat it
+    # and read it in more calls than needed
+    fd, size = open_regular_file(file_path)
+    try:
+        return crc32_of_fd(fd, size, mmap_threshold)
+    finally:
+        os.close(fd)
+
+
+class WorkerError(Exception):
+    """Raised when the workers that CRC-check the files stop working"""
+
 
 class StatusInformation:
+    __slots__ = ('nr_missing', 'nr_different', 'nr_successful',
+                 'nr_read_errors', 'nr_dirs', 'nr_files')
+
     def __init__(self, nr_files=0):
         self.nr_missing = 0
         self.nr_different = 0
@@ -50,120 +189,317 @@ class StatusInformation:
         return self.nr_read_errors == self.nr_different == self.nr_missing == 0
 
 
+class WorkList:
+    """
+    The files that are to be CRC-checked, stored as parallel lists.
+    The files in dir_names[i] are the ones with indices in dir_ranges[i]
+    """
+
+    def __init__(self):
+        self.dir_names = []
+        self.dir_ranges = []
+        self.file_names = []
+        self.file_paths = []
+        self.crcs = []
+
+    def add_dir(self, dir_name, crcs, sort=True):
+        """
+        Add the files in crcs, a dict with file_name, crc pairs, from dir_name.
+        The files are added in sorted order if sort is true, otherwise in the
+        order they were found
+        """
+        if not crcs:
+            return
+
+        start = len(self.file_names)
+        for file_name in sorted(crcs) if sort else crcs:
+            self.file_names.append(file_name)
+            self.file_paths.append(os.path.join(dir_name, file_name))
+            self.crcs.append(crcs[file_name])
+
+        self.dir_names.append(dir_name)
+        self.dir_ranges.append(range(start, len(self.file_names)))
+
+
 class Model:
     """An abstract model. Subclasses decides how the output is presented"""
 
-    def __init__(self, flags, file_names=None, dir_names=None, block_size=8192):
+    def __init__(self, flags, file_names=None, dir_names=None,
+                 block_size=4 * 1024 * 1024, mmap_threshold=65536):
         self.args = flags
         self.file_names = file_names or []
         self.dir_names = dir_names or []
         self.block_size = block_size
+        self.mmap_threshold = mmap_threshold
+        # Subclasses that don't want to be told about successful files can
+        # set this to False to skip the file_ok calls altogether
+        self.report_ok = True
         self.total_stat = StatusInformation()
+        self.executor = None
+        self.futures = collections.deque()
+        self.max_pending = 1
+        # (file_path, fd, size) of the file opened ahead on the serial path
+        self._prefetched = None
+        # The class is fixed by now, so which hooks it implements is only
+        # looked up once. If there are hooks that are called while a file is
+        # CRC-checked, the files have to be checked one at a time in the
+        # calling thread
+        self._has_block_read = self.overrides('block_read')
+        self._has_file_hooks = self._has_block_read or self.overrides('file_start')
 
     @staticmethod
     def parse(file_name):
-        """Returns the CRC parsed from the file_name or None if no CRC is found"""
-        crc = \
-            re.match(r'.*?\[([a-fA-F0-9]{8})\].*?$', file_name) or \
-            re.match(r'.*?\(([a-fA-F0-9]{8})\).*?$', file_name) or \
-            re.match(r'.*?_([a-fA-F0-9]{8})_.*?$', file_name)
+        """Returns the CRC parsed from the file_name as an int or None if no CRC is found"""
+        # A single scan finds all candidates, the one with the highest
+        # precedence is used
+        crc = None
+        for match in _CRC_PATTERN.finditer(file_name):
+            if crc is None or match.lastindex < crc.lastindex:
+                crc = match
+                if crc.lastindex == 1:
+                    break
         if crc:
-            return crc.group(1).upper()
+            return int(crc.group(crc.lastindex), 16)
 
     def parse_line(self, line):
-        """Parses a line from a sfv-file, returns a file name crc tuple"""
-        match = re.match(r'([^;]+)\s([a-fA-F0-9]{8})\s*$', line)
-        if match:
+        """
+        Parses a line from a sfv-file, given as bytes, returns a file name
+        crc tuple where the crc is an int
+        """
+        # A line is a file name followed by whitespace and the CRC. The file
+        # name can't contain ';', since that's used for comments
+        line = line.rstrip()
+        file_name, crc = line[:-9], line[-8:]
+        if (file_name and line[-9:-8].isspace() and not crc.translate(None, _HEX_DIGITS)
+                and b';' not in file_name):
             # Make Windows directories into Unix directories
             if self.args.exchange:
-                return match.group(1).replace('\\', '/'), match.group(2).upper()
-            else:
-                return match.group(1), match.group(2).upper()
-
-    def get_crcs(self, dir_name, file_names):
-        """Returns a dict with file_name, crc pairs"""
-        old_cwd = os.getcwd()
-        os.chdir(dir_name)
-
-        files = [file_name for file_name in file_names if os.path.isfile(file_name)]
-        sfv_files = [file_name for file_name in files if file_name.lower().endswith('.sfv')]
+                file_name = file_name.replace(b'\\', b'/')
+            try:
+                file_name = os.fsdecode(file_name)
+            except UnicodeDecodeError:
+                # Only surrogateescape round-trips any bytes, on Windows the
+                # handler is surrogatepass and the name simply won't be found
+                file_name = file_name.decode(sys.getfilesystemencoding(), 'replace')
+            return file_name, int(crc, 16)
+
+    def get_crcs(self, dir_name, files):
+        """
+        Returns a dict with file_name, crc pairs. files are the names of the
+        regular files in dir_name that are to be considered
+        """
+        folded_files = [file_name.casefold() for file_name in files]
+        sfv_files = [file_name for file_name, folded_file in zip(files, folded_files)
+                     if folded_file.endswith('.sfv')]
         crcs = {}
 
         # If case is to be ignore, build a dictionary with mappings from
-        # file_names with lowercase to the file names with the real case
-        no_case_files = {file_name.lower(): file_name for file_name in files}
+        # file_names case folded to the file names with the real case
+        no_case_files = {} if self.args.case else dict(zip(folded_files, files))
 
         if sfv_files and self.args.sfv:
             for sfv_file in sfv_files:
-                with open(sfv_file, 'r', errors='replace') as file_:
-                    for line in file_:
-                        result = self.parse_line(line)
-                        if result:
-                            file_name, crc = result
-                            if not self.args.case and file_name.lower() in no_case_files:
-                                crcs[no_case_files[file_name.lower()]] = crc
-                            else:
-                                crcs[file_name] = crc
+                # File names given to the model aren't checked beforehand,
+                # so sfv names that aren't regular files are skipped here
+                try:
+                    fd, _ = open_regular_file(os.path.join(dir_name, sfv_file))
+                except OSError as e:
+                    if e.errno in (errno.ENOENT, errno.EISDIR, errno.EINVAL):
+                        continue
+                    raise
+                with os.fdopen(fd, 'rb') as file_:
+                    lines = file_.read().splitlines()
+
+                for line in lines:
+                    result = self.parse_line(line)
+                    if result:
+                        file_name, crc = result
+                        if no_case_files:
+                            file_name = no_case_files.get(file_name.casefold(), file_name)
+                        crcs[file_name] = crc
 
         if self.args.crc:
             for file in files:
                 crc = self.parse(file)
-                if crc:
+                if crc is not None:
                     crcs[file] = crc
 
-        os.chdir(old_cwd)
         return crcs
 
     def crc32_of_file(self, file_path):
-        """Returns the CRC of the file filepath"""
-
-        with open(file_path, 'r+') as file_:
-            with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as map_:
-                self.file_start(file_)
-
-                current = 0
-                while True:
-                    buf = map_.read(self.block_size)
-                    if not buf:
-                        break
-                    current = zlib.crc32(buf, current)
-                    self.block_read()
-
-                # Remove everything except the last 32 bits, including the leading 0x
-                return hex(current & 0xFFFFFFFF)[2:].upper().zfill(8)
-
-    def check_dir(self, dir_name, file_names):
-        """CRC-check the files in a directory"""
-        crcs = self.get_crcs(dir_name, file_names)
-
-        if crcs:
-            dir_stat = StatusInformation(len(crcs))
-            self.directory_start(dir_name, dir_stat)
-
-            for file_name, crc in sorted(crcs.items()):
-                try:
-                    real_crc = self.crc32_of_file(os.path.join(dir_name, file_name))
-                except IOError as e:
-                    if e.errno == 2:
-                        dir_stat.nr_missing += 1
-                        self.file_missing(file_name)
+        """Returns the CRC of the file filepath as an int"""
+        fd, size = open_regular_file(file_path)
+        try:
+            return self.crc32_of_fd(fd, size)
+        finally:
+            os.close(fd)
+
+    def crc32_of_fd(self, fd, size):
+        """
+        Returns the CRC of the size bytes in the open file descriptor fd as
+        an int. The descriptor is left open
+        """
+        if not self._has_file_hooks:
+            return crc32_of_fd(fd, size, self.mmap_threshold)
+
+        with os.fdopen(fd, 'rb', closefd=False) as file_:
+            self.file_start(file_)
+
+            # Setting up a mapping costs more than reading small files
+            if size < self.mmap_threshold:
+                current = zlib.crc32(file_.read())
+                self.block_read()
+            else:
+                with map_file(fd) as map_:
+                    # Only feed the mapping in blocks if there is someone
+                    # to notify about each block
+                    if self._has_block_read:
+                        current = self._crc32_chunked(map_)
                     else:
-                        dir_stat.nr_read_errors += 1
-                        self.file_read_error(file_name)
+                        current = zlib.crc32(map_)
+
+            return current & 0xFFFFFFFF
+
+    def _crc32_chunked(self, map_):
+        """
+        Returns the CRC of the mapping map_, calculated block_size bytes at a
+        time with a call to block_read after each block
+        """
+        # Bind what the loop uses to locals to avoid lookups for every block
+        block_size = self.block_size
+        block_read = self.block_read
+        crc32 = zlib.crc32
+
+        current = 0
+        with memoryview(map_) as view:
+            for offset in range(0, len(view), block_size):
+                current = crc32(view[offset:offset + block_size], current)
+                block_read()
+        return current
+
+    def crc32_results(self, file_paths):
+        """
+        Generates one callable per file, in order, that returns the CRC of
+        the file. The CRCs are calculated by the workers if there is an
+        executor, the hooks are always called from the calling thread
+        """
+        if self.executor:
+            # Only max_pending files are submitted ahead of the one whose
+            # result is used, so the pending futures don't grow with the tree
+            file_paths = iter(file_paths)
+            for file_path in itertools.islice(file_paths, self.max_pending):
+                self.futures.append(self.executor.submit(
+                    crc32_of_file, file_path, self.mmap_threshold))
+            while self.futures:
+                future = self.futures.popleft()
+                for file_path in itertools.islice(file_paths, 1):
+                    self.futures.append(self.executor.submit(
+                        crc32_of_file, file_path, self.mmap_threshold))
+                yield future.result
+            return
+
+        # Without workers the next file is prefetched while the current
+        # one is CRC-checked, so the disk isn't idle between files
+        next_file_paths = itertools.chain(itertools.islice(file_paths, 1, None), [None])
+        for file_path, next_file_path in zip(file_paths, next_file_paths):
+            yield functools.partial(self._crc32_prefetching, file_path, next_file_path)
+
+    def _crc32_prefetching(self, file_path, next_file_path):
+        """
+        Returns the CRC of the file file_path after starting to read the
+        beginning of next_file_path in the background. The descriptor opened
+        for the prefetch is kept and used when next_file_path is checked, so
+        each file is only opened once
+        """
+        prefetched = self._prefetched
+        self._prefetched = None
+        if next_file_path:
+            next_file = prefetch_file(next_file_path, self.block_size,
+                                      self.mmap_threshold)
+            if next_file:
+                self._prefetched = (next_file_path,) + next_file
+
+        if prefetched and prefetched[0] == file_path:
+            _, fd, size = prefetched
+        else:
+            if prefetched:
+                os.close(prefetched[1])
+            fd, size = open_regular_file(file_path)
+        try:
+            return self.crc32_of_fd(fd, size)
+        finally:
+            os.close(fd)
+
+    def overrides(self, hook_name):
+        """Returns true if the hook named hook_name is implemented by a subclass"""
+        return getattr(type(self), hook_name) is not getattr(Model, hook_name)
+
+    def create_executor(self):
+        """
+        Returns the executor used to CRC-check several files at a time, or
+        None if the files are to be checked one at a time
+        """
+        # Interfaces that predate these options don't have to set them
+        jobs = getattr(self.args, 'jobs', None) or os.cpu_count() or 1
+        processes = getattr(self.args, 'processes', False)
+        if jobs <= 1 or self._has_file_hooks:
+            return None
+        # ProcessPoolExecutor refuses more than 61 workers on Windows
+        if processes and sys.platform == 'win32':
+            jobs = min(jobs, 61)
+        self.max_pending = 2 * jobs
+
+        # concurrent.futures pulls in logging and multiprocessing, so it's only
+        # imported when needed instead of slowing down --help and --version
+        if processes:
+            from concurrent.futures import ProcessPoolExecutor
+            return ProcessPoolExecutor(max_workers=jobs)
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=jobs)
+
+    def check_dir(self, work_list, dir_index, results):
+        """
+        CRC-check the files in the directory with index dir_index in work_list.
+        results is the iterator from crc32_results, positioned at the first
+        file of the directory
+        """
+        dir_range = work_list.dir_ranges[dir_index]
+        dir_stat = StatusInformation(len(dir_range))
+        self.directory_start(work_list.dir_names[dir_index], dir_stat)
+
+        # The hooks are looked up once per directory instead of once per file
+        file_ok = self.file_ok if self.report_ok else None
+        file_different = self.file_different
+        dir_slice = slice(dir_range.start, dir_range.stop)
+
+        for file_name, crc, result in zip(work_list.file_names[dir_slice],
+                                          work_list.crcs[dir_slice],
+                                          results):
+            try:
+                real_crc = result()
+            except IOError as e:
+                if e.errno == 2:
+                    dir_stat.nr_missing += 1
+                    self.file_missing(file_name)
                 else:
-                    if crc == real_crc:
-                        dir_stat.nr_successful += 1
-                        self.file_ok(file_name)
-                    else:
-                        dir_stat.nr_different += 1
-                        self.file_different(file_name, crc, real_crc)
+                    dir_stat.nr_read_errors += 1
+                    self.file_read_error(file_name)
+            else:
+                if crc == real_crc:
+                    dir_stat.nr_successful += 1
+                    if file_ok:
+                        file_ok(file_name)
+                else:
+                    dir_stat.nr_different += 1
+                    file_different(file_name, format(crc, '08X'),
+                                   format(real_crc, '08X'))
 
-            self.total_stat.update(dir_stat)
-            self.directory_end()
+        self.total_stat.update(dir_stat)
+        self.directory_end()
 
     # Hook methods, implemented by subclasses
     def file_ok(self, file_name):
-        """Called when a file was successfully CRC-checked"""
+        """Called when a file was successfully CRC-checked, if report_ok is true"""
         pass
 
     def file_missing(self, file_name):
@@ -206,28 +542,62 @@ class Model:
 
         self.start()
 
+        work_list = self.find_files()
+
+        self.executor = self.create_executor()
+        try:
+            results = self.crc32_results(work_list.file_paths)
+            for dir_index in range(len(work_list.dir_names)):
+                self.check_dir(work_list, dir_index, results)
+        except RuntimeError as e:
+            # A worker process that dies takes the whole pool with it, which
+            # is reported as an error instead of a traceback
+            if self.executor and getattr(self.args, 'processes', False):
+                from concurrent.futures.process import BrokenProcessPool
+                if isinstance(e, BrokenProcessPool):
+                    raise WorkerError("a worker process terminated abruptly") from e
+            raise
+        finally:
+            if self.executor:
+                # Files that haven't been started are dropped, e.g. after an
+                # interrupt. shutdown() only does that itself from Python 3.9
+                for future in self.futures:
+                    future.cancel()
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                self.futures.clear()
+            if self._prefetched:
+                os.close(self._prefetched[1])
+                self._prefetched = None
+
+        self.end()
+
+    def find_files(self):
+        """Returns a WorkList with all the files that are to be CRC-checked"""
+        work_list = WorkList()
+
         if self.args.directory:
             os.chdir(self.args.directory)
 
         # Mapping from a directory name to a list with the files that are
         # to be CRC-checked in that directory
         files_by_dir = {}
+        cwd = os.getcwd()
         for file_name in self.file_names:
             head, tail = os.path.split(file_name)
-            head = os.path.abspath(head)
+            # Same as os.path.abspath, without calling getcwd for every file
+            head = os.path.normpath(os.path.join(cwd, head))
             if head not in files_by_dir:
                 files_by_dir[head] = []
             files_by_dir[head].append(tail)
 
+        sort = getattr(self.args, 'sort', True)
         for dir_name, file_names in files_by_dir.items():
-            self.check_dir(dir_name, file_names)
+            work_list.add_dir(
+                dir_name, self.get_crcs(dir_name, file_names), sort)
 
         for dir_name in self.dir_names:
-            if self.args.recursive:
-                for root, dirs, files in os.walk(
-                        dir_name, followlinks=self.args.follow):
-                    self.check_dir(root, files)
-            else:
-                self.check_dir(dir_name, os.listdir(dir_name))
+            for root, files in walk(dir_name, self.args.recursive, self.args.follow):
+                work_list.add_dir(root, self.get_crcs(root, files), sort)
 
-        self.end()
+        return work_list
@@ -19,11 +19,15 @@
 
 """A commandline interface to autocrc"""
 import os
+import stat
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 from . import autocrc
 
+# Printed above the summary of each directory
+_SEPARATOR = "-" * 80
+
 
 def main():
     try:
@@ -34,10 +38,21 @@ def main():
     except OSError as e:
         print("autocrc: {}: {}".format(e.filename, e.strerror), file=sys.stderr)
         sys.exit(8)
+    except autocrc.WorkerError as e:
+        print("autocrc: {}".format(e), file=sys.stderr)
+        sys.exit(8)
     except KeyboardInterrupt:
         pass
 
 
+def positive_int(value):
+    """argparse type for options that need a number of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError("must be at least 1: {}".format(value))
+    return number
+
+
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument("--version", action='version', version='%(prog)s v1.0')
@@ -55,16 +70,33 @@ def parse_args():
                         metavar="DIR", help="use DIR as the working directory")
     parser.add_argument("-L", "--follow", action="store_true",
                         help="follow symbolic directory links in recursive mode")
+    parser.add_argument("-j", "--jobs", type=positive_int, metavar="N",
+                        help="CRC-check N files at a time, defaults to the number of CPUs")
+    parser.add_argument("-p", "--processes", action="store_true",
+                        help="use worker processes instead of threads for --jobs")
+    parser.add_argument("--no-sort", action="store_false", dest="sort",
+                        help="do not sort the files within each directory")
 
     parser.add_argument("-q", "--quiet", action="store_true",
                         help="Only print error messages and summaries")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Print the calculated CRC and the CRC it was compared against when mismatches occurs")
-    parser.add_argument("files", nargs='?', default='.')
+    parser.add_argument("files", nargs='*', default=[os.curdir])
 
     args = parser.parse_args()
-    file_names = [arg for arg in args.files if os.path.isfile(arg)]
-    dir_names = [arg for arg in args.files if os.path.isdir(arg)] if args else [os.curdir]
+
+    # Stat each argument once to find out if it's a file or a directory
+    file_names = []
+    dir_names = []
+    for arg in args.files:
+        try:
+            mode = os.stat(arg).st_mode
+        except OSError:
+            continue
+        if stat.S_ISREG(mode):
+            file_names.append(arg)
+        elif stat.S_ISDIR(mode):
+            dir_names.append(arg)
     return args, file_names, dir_names
 
 
@@ -72,15 +104,18 @@ class TextModel(autocrc.Model):
     def __init__(self, args, file_names, dir_names):
         super().__init__(args, file_names, dir_names)
         self.dir_stat = None
+        # The flags don't change during a run, so what they mean for the
+        # output is decided once
+        self.report_ok = not args.quiet
+        self.print_crcs = args.verbose
 
     def file_missing(self, file_name):
         """Print that a file is missing"""
         self.file_print(file_name, "No such file")
 
     def file_ok(self, file_name):
-        """Print that a CRC-check was successful if quiet is false"""
-        if not self.args.quiet:
-            self.file_print(file_name, "OK")
+        """Print that a CRC-check was successful, only called if quiet is false"""
+        self.file_print(file_name, "OK")
 
     def file_different(self, file_name, crc, real_crc):
         """
@@ -88,7 +123,7 @@ class TextModel(autocrc.Model):
         If verbose is set then the CRC calculated and the CRC that it was 
         compared against is also printed
         """
-        if self.args.verbose:
+        if self.print_crcs:
             self.file_print(file_name, real_crc + " != " + crc)
         else:
             self.file_print(file_name, "CRC mismatch")
@@ -108,18 +143,13 @@ class TextModel(autocrc.Model):
 
     def directory_end(self):
         """Print a summary of a directory."""
-        print("-" * 80)
-
-        if self.dir_stat.everything_ok():
-            print("Everything OK")
-        else:
-            print("Errors occurred")
-        print(
-            "Tested {0} files, Successful {1}, "
-            "Different {2}, Missing {3}, Read errors {4}\n".format(
-                self.dir_stat.nr_files, self.dir_stat.nr_successful,
-                self.dir_stat.nr_different, self.dir_stat.nr_missing,
-                self.dir_stat.nr_read_errors))
+        dir_stat = self.dir_stat
+        status = "Everything OK" if dir_stat.everything_ok() else "Errors occurred"
+        sys.stdout.write(
+            f"{_SEPARATOR}\n{status}\n"
+            f"Tested {dir_stat.nr_files} files, Successful {dir_stat.nr_successful}, "
+            f"Different {dir_stat.nr_different}, Missing {dir_stat.nr_missing}, "
+            f"Read errors {dir_stat.nr_read_errors}\n\n")
 
     def end(self):
         """Print a total summary if more than one directory was scanned"""
@@ -137,16 +167,17 @@ class TextModel(autocrc.Model):
             print("  Missing\t", self.total_stat.nr_missing, "files")
             print("  Read Errors\t", self.total_stat.nr_read_errors, "files")
 
-        # Set the exit status to the value explained in usage()
-        sys.exit((self.total_stat.nr_different > 0) +
-                 (self.total_stat.nr_missing > 0) * 2 +
-                 (self.total_stat.nr_read_errors > 0) * 4)
+        # Set the exit status to the value explained in usage(), one bit for
+        # each kind of error
+        sys.exit(bool(self.total_stat.nr_different) |
+                 bool(self.total_stat.nr_missing) << 1 |
+                 bool(self.total_stat.nr_read_errors) << 2)
 
     @staticmethod
     def file_print(file_name, status):
-        pad_len = max(0, 77 - len(file_name))
+        # str.rjust leaves the status as it is if the name is too long to pad
         norm_file_name = os.path.normpath(file_name)
-        print("{0} {1:>{2}}".format(norm_file_name, status, pad_len))
+        sys.stdout.write(norm_file_name + " " + status.rjust(77 - len(file_name)) + "\n")
 
 
 if __name__ == '__main__':